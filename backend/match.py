@@ -6,15 +6,41 @@ CLIP AI matching for 3D glasses models with color/material extraction
 import sys
 import os
 import json
+import re
 import time
 import colorsys
+import functools
+
+try:
+    import numpy as np
+    from PIL import Image
+    _HAVE_NUMPY = True
+except ImportError:
+    _HAVE_NUMPY = False
 
 REF_DIR = "reference_images"
-EMBEDDINGS_FILE = "reference_embeddings.pt"
+EMBEDDINGS_FILE = "reference_embeddings.npy"
+EMBEDDINGS_META_FILE = "reference_embeddings.json"
+LEGACY_EMBEDDINGS_FILE = "reference_embeddings.pt"
+FAISS_INDEX_FILE = "reference_embeddings.faiss"
+
+# Set JIGU_DEBUG=1 for per-match diagnostics and tracebacks on unexpected errors
+DEBUG = bool(os.getenv("JIGU_DEBUG"))
 
 # Available models in Wasabi (will be populated from S3)
 AVAILABLE_MODELS = []
 
+# Loaded CLIP (torch, model, processor, device, Image), shared by all callers
+_CLIP_CACHE = None
+
+# FAISS inner-product index over the reference embeddings, read once per process
+_FAISS_INDEX = None
+
+# Shape-name score adjustments in clip_match; together they bound how far
+# below the best raw score a reference can be and still win after boosting
+SHAPE_BOOST = 0.15
+SHAPE_PENALTY = 0.1
+
 # Shape keywords for matching
 SHAPE_KEYWORDS = {
     'round': ['round', 'circular', 'circle', 'oval', 'metal_round', 'lennon', 'vintage', 'retro', 'classic'],
@@ -31,18 +57,78 @@ SHAPE_KEYWORDS = {
     'geometric': ['geometric', 'hexagon', 'octagon', 'polygon'],
 }
 
+# One alternation regex per shape, so each model name is scanned once
+_SHAPE_RE = {
+    shape: re.compile('|'.join(map(re.escape, kws)), re.IGNORECASE)
+    for shape, kws in SHAPE_KEYWORDS.items()
+}
+_GLASSES_NAME_RE = re.compile('glasses|spectacle|eyewear', re.IGNORECASE)
+
+# Reference-name keywords used to boost CLIP scores by detected frame shape
+RECT_KEYWORDS = ['rayban', 'ray_ban', 'wayfarer', 'black_glasses', 'rectangular', 'square', 'nerd', 'hipster', 'reading']
+ROUND_KEYWORDS = ['round', 'circle', 'metal_round', 'lennon', 'vintage']
+_RECT_RE = re.compile('|'.join(map(re.escape, RECT_KEYWORDS)), re.IGNORECASE)
+_ROUND_RE = re.compile('|'.join(map(re.escape, ROUND_KEYWORDS)), re.IGNORECASE)
+
+# Text prompts for glasses/non-glasses classification
+GLASSES_PROMPTS = [
+    "a photo of eyeglasses",
+    "a photo of sunglasses",
+    "a photo of spectacles",
+    "a photo of reading glasses",
+    "a photo of prescription glasses",
+    "a photo of eyewear",
+    "a photo of optical frames"
+]
+
+NON_GLASSES_PROMPTS = [
+    "a photo of a person",
+    "a photo of a face",
+    "a photo of food",
+    "a photo of an animal",
+    "a photo of a cat",
+    "a photo of a dog",
+    "a photo of a phone",
+    "a photo of a car",
+    "a photo of a building",
+    "a photo of nature",
+    "a photo of clothing",
+    "a photo of shoes",
+    "a photo of a watch",
+    "a photo of text or document",
+    "a photo of furniture",
+    "a photo of electronics"
+]
+
+ALL_PROMPTS = GLASSES_PROMPTS + NON_GLASSES_PROMPTS
+
+# Normalized CLIP text features for ALL_PROMPTS, computed once per process
+_PROMPT_FEATS = None
+
 def set_available_models(models):
     """Set the list of available models from S3"""
     global AVAILABLE_MODELS
     AVAILABLE_MODELS = models
 
 
+def import_ndimage():
+    """Import scipy.ndimage on first use, or return None if scipy is not installed"""
+    # Not imported at module load: every request spawns a fresh match.py process
+    try:
+        from scipy import ndimage
+        return ndimage
+    except ImportError:
+        return None
+
+
 def remove_background(image):
     """Remove background from glasses image to improve matching"""
+    ndimage = import_ndimage() if _HAVE_NUMPY else None
+    if ndimage is None:
+        # scipy not available, return original
+        return image
+
     try:
-        import numpy as np
-        from PIL import Image
-        
         img_array = np.array(image)
         
         # Convert to grayscale for edge detection
@@ -56,8 +142,11 @@ def remove_background(image):
         height, width = gray.shape
         
         # Calculate local variance to find edges/details
-        from scipy import ndimage
-        variance = ndimage.generic_filter(gray, np.var, size=5)
+        # var = E[x^2] - E[x]^2 over a 5x5 window, using separable box filters
+        gray_f = gray.astype(np.float32)
+        mean = ndimage.uniform_filter(gray_f, size=5)
+        mean_sq = ndimage.uniform_filter(gray_f * gray_f, size=5)
+        variance = mean_sq - mean * mean
         
         # Create mask: keep areas with high variance (edges, details) or darker areas
         mask = (variance > 100) | (gray < 200)
@@ -65,34 +154,56 @@ def remove_background(image):
         # Dilate mask to include nearby pixels
         mask = ndimage.binary_dilation(mask, iterations=3)
         
-        # Apply mask - set background to white
-        result = img_array.copy()
-        if len(result.shape) == 3:
-            for c in range(3):
-                result[:, :, c] = np.where(mask, result[:, :, c], 255)
-        
-        return Image.fromarray(result.astype(np.uint8))
-    except ImportError:
-        # scipy not available, return original
-        return image
+        # Apply mask - set background to white (one broadcast pass over all channels)
+        if len(img_array.shape) == 3:
+            result = np.where(mask[:, :, None], img_array, np.uint8(255))
+        else:
+            result = img_array
+
+        return Image.fromarray(result.astype(np.uint8, copy=False))
     except Exception as e:
         print(f"Background removal failed: {e}", file=sys.stderr)
         return image
 
 
+def downscale(image, size):
+    """Resize to size x size; Pillow box-reduces large images first, then applies its default filter"""
+    return image.resize((size, size), reducing_gap=3.0)
+
+
+def load_image(path, mode="RGB", size=None):
+    """
+    Decode an image file once and share it across the analysis steps.
+    With size, returns a downscaled size x size copy. Callers must not modify the result.
+    """
+    return _load_image(path, mode, size)
+
+
+@functools.lru_cache(maxsize=32)
+def _load_image(path, mode, size):
+    if size is not None:
+        return downscale(_load_image(path, mode, None), size)
+    if mode != "RGB":
+        return _load_image(path, "RGB", None).convert(mode)
+    with Image.open(path) as img:
+        return img.convert("RGB")
+
+
 def analyze_frame_shape(image):
     """Analyze the frame shape from an image - returns shape characteristics"""
     try:
-        import numpy as np
-        from PIL import Image
-        
         img = image.convert('L')  # Grayscale
-        img = img.resize((100, 100))
+        img = downscale(img, 100)
         pixels = np.array(img)
-        
-        # Find edges using simple gradient
-        gx = np.abs(np.diff(pixels.astype(float), axis=1))
-        gy = np.abs(np.diff(pixels.astype(float), axis=0))
+
+        # Near-uniform image (blank or solid): no edges or frame to measure
+        if pixels.std() < 5.0:
+            return {"aspect_ratio": 1.5, "is_rectangular": False, "is_round": False, "horizontal_score": 0, "vertical_score": 0}
+
+        # Find edges using simple gradient (int16 holds any uint8 difference exactly)
+        p16 = pixels.astype(np.int16)
+        gx = np.abs(np.diff(p16, axis=1))
+        gy = np.abs(np.diff(p16, axis=0))
         
         # Threshold to get edge pixels
         threshold = 30
@@ -123,8 +234,8 @@ def analyze_frame_shape(image):
             rows = np.any(dark_mask, axis=1)
             cols = np.any(dark_mask, axis=0)
             if np.any(rows) and np.any(cols):
-                rmin, rmax = np.where(rows)[0][[0, -1]]
-                cmin, cmax = np.where(cols)[0][[0, -1]]
+                rmin, rmax = rows.argmax(), len(rows) - rows[::-1].argmax() - 1
+                cmin, cmax = cols.argmax(), len(cols) - cols[::-1].argmax() - 1
                 height = rmax - rmin
                 width = cmax - cmin
                 aspect_ratio = width / max(height, 1)
@@ -164,44 +275,41 @@ def list_refs():
 
 def extract_glasses_properties(image_paths):
     """Extract lens color, frame color, material type from uploaded images"""
-    try:
-        from PIL import Image
-        import numpy as np
-    except ImportError:
+    if not _HAVE_NUMPY:
         return {"lensColor": "#3b82f6", "frameColor": "#1a1a1a", "tintOpacity": 0.5, "frameScale": 1.0, "frameMaterial": "plastic", "frameMetalness": 0.1}
     
     all_lens_colors = []
     all_frame_colors = []
-    all_frame_pixels = []
+    all_frame_pixels_list = []
     
     for img_path in image_paths:
         try:
-            img = Image.open(img_path).convert('RGB')
-            width, height = img.size
-            
-            # Resize for faster processing
-            img_small = img.resize((100, 100))
+            # Resize for faster processing (Pillow's default filter, as the color thresholds expect)
+            img_small = load_image(img_path).resize((100, 100))
             pixels = np.array(img_small)
             pixels_flat = pixels.reshape(-1, 3)
             
-            brightness = np.mean(pixels_flat, axis=1)
+            # Brightness as an integer R+G+B sum (3x the mean), computed once and
+            # shared with the lens region below; thresholds are scaled by 3 to match
+            bsum = pixels_flat.sum(axis=1, dtype=np.uint16)
             
             # Frame colors: darker pixels
-            dark_mask = (brightness > 10) & (brightness < 100)
+            dark_mask = (bsum > 10 * 3) & (bsum < 100 * 3)
             dark_pixels = pixels_flat[dark_mask]
             
             if len(dark_pixels) > 10:
-                frame_color = np.median(dark_pixels, axis=0).astype(int)
+                # Per-channel median via O(n) selection instead of a full sort
+                k = len(dark_pixels) // 2
+                frame_color = np.partition(dark_pixels, k, axis=0)[k].astype(int)
                 all_frame_colors.append(frame_color)
-                all_frame_pixels.extend(dark_pixels.tolist())
+                all_frame_pixels_list.append(dark_pixels)
             
-            # Lens colors from center region
-            center_crop = img.crop((width//4, height//4, 3*width//4, 3*height//4))
-            center_crop = center_crop.resize((50, 50))
-            center_pixels = np.array(center_crop).reshape(-1, 3)
-            center_brightness = np.mean(center_pixels, axis=1)
+            # Lens colors from center region (middle 50x50 of the resized image)
+            bsum_2d = bsum.reshape(pixels.shape[:2])
+            center_pixels = pixels[25:75, 25:75].reshape(-1, 3)
+            center_bsum = bsum_2d[25:75, 25:75].ravel()
             
-            tint_mask = (center_brightness > 30) & (center_brightness < 200)
+            tint_mask = (center_bsum > 30 * 3) & (center_bsum < 200 * 3)
             tint_pixels = center_pixels[tint_mask]
             
             if len(tint_pixels) > 5:
@@ -213,7 +321,7 @@ def extract_glasses_properties(image_paths):
             continue
     
     # Detect frame material
-    frame_pixels_array = np.array(all_frame_pixels) if all_frame_pixels else np.array([[50, 50, 50]])
+    frame_pixels_array = np.concatenate(all_frame_pixels_list, axis=0) if all_frame_pixels_list else np.array([[50, 50, 50]])
     
     # Metal detection: low color variance but high brightness variance
     if len(frame_pixels_array) > 10:
@@ -309,77 +417,81 @@ def simple_match(image_paths=None):
     }
 
 
+def _shape_stats(pixels, threshold):
+    """
+    Shape statistics of the dark region in a grayscale image.
+    Returns (height, width, fill_ratio, circularity); height is -1 if no pixel is below threshold.
+    """
+    dark_mask = pixels < threshold
+    if not np.any(dark_mask):
+        return -1, -1, 0.0, 1.0
+
+    # Find bounding box
+    rows = np.any(dark_mask, axis=1)
+    cols = np.any(dark_mask, axis=0)
+    rmin, rmax = rows.argmax(), len(rows) - rows[::-1].argmax() - 1
+    cmin, cmax = cols.argmax(), len(cols) - cols[::-1].argmax() - 1
+
+    height = rmax - rmin
+    width = cmax - cmin
+    if height == 0 or width == 0:
+        return height, width, 0.0, 1.0
+
+    # Extract the glasses region
+    region = dark_mask[rmin:rmax, cmin:cmax]
+
+    # Calculate fill ratio (how much of bounding box is filled)
+    fill_ratio = np.sum(region) / region.size
+
+    # Calculate circularity - round glasses have high circularity
+    # Check if the shape is more circular by looking at the corners
+    h, w = region.shape
+    if h > 10 and w > 10:
+        # Check corners - round glasses have less fill in corners
+        corner_size = min(h, w) // 4
+        corners = [
+            region[:corner_size, :corner_size],  # top-left
+            region[:corner_size, -corner_size:],  # top-right
+            region[-corner_size:, :corner_size],  # bottom-left
+            region[-corner_size:, -corner_size:]  # bottom-right
+        ]
+        corner_fill = (corners[0].mean() + corners[1].mean() + corners[2].mean() + corners[3].mean()) * 0.25
+        center_region = region[h//4:3*h//4, w//4:3*w//4]
+        center_fill = np.mean(center_region) if center_region.size > 0 else 0
+
+        circularity = center_fill / (corner_fill + 0.01)  # Higher = more round
+    else:
+        circularity = 1.0
+
+    return height, width, fill_ratio, circularity
+
+
 def detect_glasses_shape(image_paths):
     """Detect the shape of glasses from uploaded images"""
     try:
-        from PIL import Image
-        import numpy as np
-        
         shapes_detected = []
         
         for img_path in image_paths:
-            img = Image.open(img_path).convert('L')  # Grayscale
-            img = img.resize((200, 200))
+            img = load_image(img_path, 'L', 200)  # Grayscale
             pixels = np.array(img)
             
             # Find the glasses region (darker pixels)
             # Use adaptive threshold based on image
             mean_val = np.mean(pixels)
             threshold = min(mean_val * 0.8, 180)
-            dark_mask = pixels < threshold
+            height, width, fill_ratio, circularity = _shape_stats(pixels, float(threshold))
             
-            if not np.any(dark_mask):
+            if height < 0:
                 print(f"  No dark pixels found in {img_path}", file=sys.stderr)
                 continue
             
-            # Find bounding box
-            rows = np.any(dark_mask, axis=1)
-            cols = np.any(dark_mask, axis=0)
-            
-            if not np.any(rows) or not np.any(cols):
-                continue
-                
-            rmin, rmax = np.where(rows)[0][[0, -1]]
-            cmin, cmax = np.where(cols)[0][[0, -1]]
-            
-            height = rmax - rmin
-            width = cmax - cmin
-            
             if height == 0 or width == 0:
                 continue
             
             aspect_ratio = width / height
             print(f"  Image aspect ratio: {aspect_ratio:.2f}", file=sys.stderr)
-            
-            # Extract the glasses region
-            region = dark_mask[rmin:rmax, cmin:cmax]
-            
-            # Calculate fill ratio (how much of bounding box is filled)
-            total_pixels = region.size
-            dark_pixels = np.sum(region)
-            fill_ratio = dark_pixels / total_pixels if total_pixels > 0 else 0
             print(f"  Fill ratio: {fill_ratio:.2f}", file=sys.stderr)
-            
-            # Calculate circularity - round glasses have high circularity
-            # Check if the shape is more circular by looking at the corners
-            h, w = region.shape
-            if h > 10 and w > 10:
-                # Check corners - round glasses have less fill in corners
-                corner_size = min(h, w) // 4
-                corners = [
-                    region[:corner_size, :corner_size],  # top-left
-                    region[:corner_size, -corner_size:],  # top-right
-                    region[-corner_size:, :corner_size],  # bottom-left
-                    region[-corner_size:, -corner_size:]  # bottom-right
-                ]
-                corner_fill = np.mean([np.mean(c) for c in corners])
-                center_region = region[h//4:3*h//4, w//4:3*w//4]
-                center_fill = np.mean(center_region) if center_region.size > 0 else 0
-                
-                circularity = center_fill / (corner_fill + 0.01)  # Higher = more round
-                print(f"  Circularity score: {circularity:.2f}", file=sys.stderr)
-            else:
-                circularity = 1.0
+            print(f"  Circularity score: {circularity:.2f}", file=sys.stderr)
             
             # Detect shape type based on multiple factors
             # Round glasses: aspect ratio close to 1, high circularity, lower corner fill
@@ -447,14 +559,13 @@ def match_by_shape(image_paths, properties):
         shape_keywords = SHAPE_KEYWORDS.get(detected_shape, [detected_shape])
         print(f"Looking for keywords: {shape_keywords}", file=sys.stderr)
         
+        shape_re = _SHAPE_RE.get(detected_shape) or re.compile(re.escape(detected_shape), re.IGNORECASE)
         matching_models = []
         for model in models:
-            model_lower = model.lower()
-            for keyword in shape_keywords:
-                if keyword in model_lower:
-                    matching_models.append(model)
-                    print(f"  Found match: {model} (keyword: {keyword})", file=sys.stderr)
-                    break
+            hit = shape_re.search(model)
+            if hit:
+                matching_models.append(model)
+                print(f"  Found match: {model} (keyword: {hit.group(0).lower()})", file=sys.stderr)
         
         print(f"Found {len(matching_models)} matching models", file=sys.stderr)
         
@@ -462,7 +573,7 @@ def match_by_shape(image_paths, properties):
         if not matching_models:
             print("No shape matches, using generic glasses models", file=sys.stderr)
             # Filter out non-glasses models
-            glasses_models = [m for m in models if 'glasses' in m.lower() or 'spectacle' in m.lower() or 'eyewear' in m.lower()]
+            glasses_models = [m for m in models if _GLASSES_NAME_RE.search(m)]
             if glasses_models:
                 matching_models = glasses_models[:10]  # Take first 10
             else:
@@ -501,14 +612,42 @@ def get_models_from_file():
     return []
 
 
+def clip_dtype(torch, device):
+    """Inference dtype for CLIP: fp16 on CUDA, bf16 on CPUs with AMX, fp32 otherwise"""
+    if device == "cuda":
+        return torch.float16
+    is_amx_supported = getattr(torch.cpu, "_is_amx_tile_supported", None)
+    if is_amx_supported is not None and is_amx_supported():
+        return torch.bfloat16
+    return torch.float32
+
+
+def normalize_features(feats):
+    """L2-normalize CLIP features in fp32, whatever precision the model ran in"""
+    feats = feats.float()
+    return feats / feats.norm(p=2, dim=-1, keepdim=True)
+
+
+def clip_image_inputs(processor, images, device, dtype):
+    """Preprocess images for CLIP on device; only the float pixel tensor is cast to the model dtype"""
+    # BatchEncoding.to() only takes a device in transformers 4.x, so cast separately
+    inputs = processor(images=images, return_tensors="pt", padding=True).to(device)
+    inputs["pixel_values"] = inputs["pixel_values"].to(dtype)
+    return inputs
+
+
 def load_clip():
+    global _CLIP_CACHE
+    if _CLIP_CACHE is not None:
+        return _CLIP_CACHE
+
     try:
         import torch
         from transformers import CLIPProcessor, CLIPModel
         from PIL import Image
 
-        device = "cpu"
-        
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+
         # Try to load model with safetensors to avoid torch.load vulnerability
         try:
             model = CLIPModel.from_pretrained("openai/clip-vit-base-patch32", use_safetensors=True).to(device)
@@ -517,7 +656,9 @@ def load_clip():
             model = CLIPModel.from_pretrained("openai/clip-vit-base-patch32").to(device)
             
         processor = CLIPProcessor.from_pretrained("openai/clip-vit-base-patch32")
-        return torch, model, processor, device, Image
+        model = model.to(clip_dtype(torch, device))
+        _CLIP_CACHE = (torch, model, processor, device, Image)
+        return _CLIP_CACHE
     except ImportError as e:
         print(f"Import error: {e}", file=sys.stderr)
         return None
@@ -526,6 +667,17 @@ def load_clip():
         return None
 
 
+def get_prompt_features(torch, model, processor, device):
+    """Return normalized text features for ALL_PROMPTS (the text tower runs only once)"""
+    global _PROMPT_FEATS
+    if _PROMPT_FEATS is None:
+        with torch.inference_mode():
+            text_inputs = processor(text=ALL_PROMPTS, return_tensors="pt", padding=True).to(device)
+            text_feats = model.get_text_features(**text_inputs)
+            _PROMPT_FEATS = normalize_features(text_feats)
+    return _PROMPT_FEATS
+
+
 def validate_glasses_image(image_paths):
     """
     Validate that uploaded images are actually glasses/eyewear.
@@ -539,44 +691,12 @@ def validate_glasses_image(image_paths):
     
     torch, model, processor, device, Image = loaded
     
-    # Define text prompts for classification
-    glasses_prompts = [
-        "a photo of eyeglasses",
-        "a photo of sunglasses", 
-        "a photo of spectacles",
-        "a photo of reading glasses",
-        "a photo of prescription glasses",
-        "a photo of eyewear",
-        "a photo of optical frames"
-    ]
-    
-    non_glasses_prompts = [
-        "a photo of a person",
-        "a photo of a face",
-        "a photo of food",
-        "a photo of an animal",
-        "a photo of a cat",
-        "a photo of a dog",
-        "a photo of a phone",
-        "a photo of a car",
-        "a photo of a building",
-        "a photo of nature",
-        "a photo of clothing",
-        "a photo of shoes",
-        "a photo of a watch",
-        "a photo of text or document",
-        "a photo of furniture",
-        "a photo of electronics"
-    ]
-    
-    all_prompts = glasses_prompts + non_glasses_prompts
-    
     try:
         # Process all images
         images = []
         for path in image_paths:
             try:
-                img = Image.open(path).convert("RGB")
+                img = load_image(path)
                 images.append(img)
             except Exception as e:
                 print(f"Error loading image {path}: {e}", file=sys.stderr)
@@ -585,32 +705,28 @@ def validate_glasses_image(image_paths):
         if not images:
             return False, 0.0, "Could not load any images"
         
-        # Check each image
-        glasses_scores = []
-        non_glasses_scores = []
-        
-        with torch.no_grad():
-            for img in images:
-                # Process image and text
-                inputs = processor(
-                    text=all_prompts,
-                    images=img,
-                    return_tensors="pt",
-                    padding=True
-                ).to(device)
-                
-                outputs = model(**inputs)
-                logits_per_image = outputs.logits_per_image
-                probs = logits_per_image.softmax(dim=1).squeeze()
-                
-                # Sum probabilities for glasses and non-glasses categories
-                glasses_prob = sum(probs[i].item() for i in range(len(glasses_prompts)))
-                non_glasses_prob = sum(probs[i].item() for i in range(len(glasses_prompts), len(all_prompts)))
-                
-                glasses_scores.append(glasses_prob)
-                non_glasses_scores.append(non_glasses_prob)
-                
-                print(f"Image validation - Glasses prob: {glasses_prob:.3f}, Non-glasses prob: {non_glasses_prob:.3f}", file=sys.stderr)
+        # Text features never change, so only the image tower runs
+        prompt_feats = get_prompt_features(torch, model, processor, device)
+
+        # Check all images in a single batch
+        with torch.inference_mode():
+            inputs = clip_image_inputs(processor, images, device, model.dtype)
+            image_feats = normalize_features(model.get_image_features(**inputs))
+
+            logits_per_image = image_feats @ prompt_feats.T * model.logit_scale.float().exp()
+            probs = logits_per_image.softmax(dim=1)
+
+            # Sum probabilities for glasses and non-glasses categories,
+            # reading both back to Python in a single transfer
+            n_glasses = len(GLASSES_PROMPTS)
+            scores = torch.stack(
+                (probs[:, :n_glasses].sum(dim=1), probs[:, n_glasses:].sum(dim=1)), dim=1
+            ).tolist()
+
+        glasses_scores = [s[0] for s in scores]
+        non_glasses_scores = [s[1] for s in scores]
+        for glasses_prob, non_glasses_prob in scores:
+            print(f"Image validation - Glasses prob: {glasses_prob:.3f}, Non-glasses prob: {non_glasses_prob:.3f}", file=sys.stderr)
         
         # Average scores across all images
         avg_glasses_score = sum(glasses_scores) / len(glasses_scores)
@@ -643,6 +759,13 @@ def validate_glasses_image(image_paths):
         return True, 1.0, None
 
 
+def shape_keyword_masks(filenames):
+    """Per-reference flags: (name has a rectangular keyword, name has a round keyword)"""
+    rect_mask = [_RECT_RE.search(name) is not None for name in filenames]
+    round_mask = [_ROUND_RE.search(name) is not None for name in filenames]
+    return rect_mask, round_mask
+
+
 def build_embeddings():
     print("Building embeddings...", file=sys.stderr)
     loaded = load_clip()
@@ -661,14 +784,27 @@ def build_embeddings():
     try:
         ref_imgs = [Image.open(p).convert("RGB") for p in ref_paths]
 
-        with torch.no_grad():
-            ref_inputs = processor(
-                images=ref_imgs, return_tensors="pt", padding=True
-            ).to(device)
-            ref_feats = model.get_image_features(**ref_inputs)
-            ref_feats = ref_feats / ref_feats.norm(p=2, dim=-1, keepdim=True)
+        with torch.inference_mode():
+            ref_inputs = clip_image_inputs(processor, ref_imgs, device, model.dtype)
+            ref_feats = normalize_features(model.get_image_features(**ref_inputs))
+
+        # Drop the old index first so it can never be paired with the new cache
+        if os.path.exists(FAISS_INDEX_FILE):
+            os.remove(FAISS_INDEX_FILE)
 
-        torch.save({"features": ref_feats, "filenames": refs}, EMBEDDINGS_FILE)
+        # fp16 .npy so clip_match can memory-map it; filenames go in a sibling JSON
+        ref_feats_np = ref_feats.cpu().numpy().astype(np.float16)
+        np.save(EMBEDDINGS_FILE, ref_feats_np)
+        rect_mask, round_mask = shape_keyword_masks(refs)
+        with open(EMBEDDINGS_META_FILE, "w") as f:
+            json.dump({"filenames": refs, "rect_mask": rect_mask, "round_mask": round_mask}, f)
+
+        # Exact inner-product index (= cosine similarity on normalized features)
+        faiss = import_faiss()
+        if faiss is not None:
+            index = faiss.IndexFlatIP(ref_feats_np.shape[1])
+            index.add(ref_feats.cpu().numpy().astype(np.float32))
+            faiss.write_index(index, FAISS_INDEX_FILE)
 
         print(f"Saved embeddings to {EMBEDDINGS_FILE}", file=sys.stderr)
         return True
@@ -677,7 +813,57 @@ def build_embeddings():
         return False
 
 
+def import_faiss():
+    """Import the optional faiss module on first use, or return None if it is not installed"""
+    # Not imported at module load: every request spawns a fresh match.py process
+    try:
+        import faiss
+        return faiss
+    except ImportError:
+        return None
+
+
+def load_faiss_index():
+    """Return the cached FAISS reference index, or None if faiss or the index file is missing"""
+    global _FAISS_INDEX
+    if _FAISS_INDEX is None and os.path.exists(FAISS_INDEX_FILE):
+        faiss = import_faiss()
+        if faiss is None:
+            return None
+        try:
+            _FAISS_INDEX = faiss.read_index(FAISS_INDEX_FILE)
+        except Exception as e:
+            print(f"Failed to load FAISS index: {e}", file=sys.stderr)
+    return _FAISS_INDEX
+
+
+def reference_similarities(torch, mean_feat, ref_feats, n_refs, device):
+    """
+    Cosine similarity of the (1, d) query against the references that can still win.
+    Returns (sims, candidates): candidates holds the reference index of each score,
+    or is None when sims covers every reference in order.
+    """
+    index = load_faiss_index()
+    if index is not None and index.ntotal == n_refs:
+        query = mean_feat.cpu().numpy().astype(np.float32)
+        top_score, _ = index.search(query, 1)
+        # The shape boosts cannot lift anything further below the best score
+        radius = float(top_score[0, 0]) - SHAPE_BOOST - SHAPE_PENALTY - 1e-6
+        _, scores, ids = index.range_search(query, radius)
+        # Reference order, so ties resolve the same way as the full matmul
+        order = np.argsort(ids, kind="stable")
+        return torch.from_numpy(scores[order]), torch.from_numpy(ids[order])
+
+    # On GPU the fp16 cache goes up as-is and the matmul runs in half precision
+    np_dtype = np.float16 if device == "cuda" else np.float32
+    ref_feats_t = torch.from_numpy(np.asarray(ref_feats, dtype=np_dtype)).to(device)
+    return (mean_feat.to(ref_feats_t.dtype) @ ref_feats_t.T).squeeze(0).float(), None
+
+
 def clip_match(image_paths):
+    # Uploads from an earlier request may reuse a path; decode them fresh
+    _load_image.cache_clear()
+
     # First, validate that images are actually glasses
     is_valid, validation_confidence, rejection_reason = validate_glasses_image(image_paths)
     if not is_valid:
@@ -698,14 +884,29 @@ def clip_match(image_paths):
 
     ref_feats = None
     ref_filenames = []
+    rect_mask = round_mask = None
 
-    if os.path.exists(EMBEDDINGS_FILE):
+    if os.path.exists(EMBEDDINGS_FILE) and os.path.exists(EMBEDDINGS_META_FILE):
         try:
             print(
                 f"Loading cached embeddings from {EMBEDDINGS_FILE}...", file=sys.stderr
             )
-            data = torch.load(EMBEDDINGS_FILE, weights_only=False)
-            ref_feats = data["features"]
+            # Memory-mapped: the features are only read from disk when used
+            ref_feats = np.load(EMBEDDINGS_FILE, mmap_mode="r")
+            with open(EMBEDDINGS_META_FILE, "r") as f:
+                meta = json.load(f)
+            ref_filenames = meta["filenames"]
+            rect_mask = meta.get("rect_mask")
+            round_mask = meta.get("round_mask")
+        except Exception as e:
+            print(f"Failed to load embeddings: {e}", file=sys.stderr)
+    elif os.path.exists(LEGACY_EMBEDDINGS_FILE):
+        try:
+            print(
+                f"Loading legacy embeddings from {LEGACY_EMBEDDINGS_FILE}...", file=sys.stderr
+            )
+            data = torch.load(LEGACY_EMBEDDINGS_FILE, weights_only=False)
+            ref_feats = data["features"].cpu().numpy()
             ref_filenames = data["filenames"]
         except Exception as e:
             print(f"Failed to load embeddings: {e}", file=sys.stderr)
@@ -729,69 +930,63 @@ def clip_match(image_paths):
         # We really want to use the cache.
         return simple_match(image_paths)
 
+    # Caches built before the masks were stored get them computed here
+    if rect_mask is None or round_mask is None:
+        rect_mask, round_mask = shape_keyword_masks(ref_filenames)
+
     try:
         # Encode uploaded images with background removal
         print(f"Processing {len(image_paths)} uploaded images with background removal...", file=sys.stderr)
         up_imgs = []
         for p in image_paths:
-            img = Image.open(p).convert("RGB")
+            img = load_image(p)
             # Remove background for better matching
             img_clean = remove_background(img)
             up_imgs.append(img_clean)
 
-        with torch.no_grad():
-            up_inputs = processor(images=up_imgs, return_tensors="pt", padding=True).to(
-                device
-            )
-            up_feats = model.get_image_features(**up_inputs)
-            up_feats = up_feats / up_feats.norm(p=2, dim=-1, keepdim=True)
+        with torch.inference_mode():
+            up_inputs = clip_image_inputs(processor, up_imgs, device, model.dtype)
+            up_feats = normalize_features(model.get_image_features(**up_inputs))
 
         # Find best match
         mean_feat = up_feats.mean(dim=0, keepdim=True)
         mean_feat = mean_feat / mean_feat.norm(p=2, dim=-1, keepdim=True)
 
-        sims = (mean_feat @ ref_feats.T).squeeze(0)
+        sims, candidates = reference_similarities(torch, mean_feat, ref_feats, len(ref_filenames), device)
+        # A single query over a small reference set finishes faster on the CPU
+        if sims.numel() < 512:
+            sims = sims.cpu()
         
         # Analyze uploaded image shape
         uploaded_shape = analyze_frame_shape(up_imgs[0])
-        print(f"Uploaded image shape analysis: {uploaded_shape}", file=sys.stderr)
+        if DEBUG:
+            print(f"Uploaded image shape analysis: {uploaded_shape}", file=sys.stderr)
         
-        # Boost scores for references with matching shape keywords
-        # Rectangular/wayfarer keywords
-        rectangular_keywords = ['rayban', 'ray_ban', 'wayfarer', 'black_glasses', 'rectangular', 'square', 'nerd', 'hipster', 'reading']
-        round_keywords = ['round', 'circle', 'metal_round', 'lennon', 'vintage']
+        # Boost references whose name matches the uploaded frame shape (+15%)
+        # and penalize the opposite shape (-10%), using the precomputed masks
+        # (restricted to the candidate references when the index pre-filtered them)
+        if uploaded_shape.get("is_rectangular"):
+            match_mask, opp_mask, label = rect_mask, round_mask, "rectangular"
+        elif uploaded_shape.get("is_round"):
+            match_mask, opp_mask, label = round_mask, rect_mask, "round"
+        else:
+            match_mask = opp_mask = None
+
+        if match_mask is not None:
+            match_t = torch.tensor(match_mask, dtype=torch.bool, device=sims.device)
+            opp_t = torch.tensor(opp_mask, dtype=torch.bool, device=sims.device)
+            if candidates is not None:
+                match_t, opp_t = match_t[candidates], opp_t[candidates]
+            sims_boosted = sims + SHAPE_BOOST * match_t.to(sims.dtype) - SHAPE_PENALTY * opp_t.to(sims.dtype)
+            if DEBUG:
+                print(f"  Boosting {int(match_t.sum())} of {sims.numel()} references ({label} match)", file=sys.stderr)
+        else:
+            sims_boosted = sims
         
-        sims_boosted = sims.clone()
-        for i, ref_name in enumerate(ref_filenames):
-            ref_lower = ref_name.lower()
-            
-            if uploaded_shape.get("is_rectangular"):
-                # Boost rectangular frame references
-                for kw in rectangular_keywords:
-                    if kw in ref_lower:
-                        sims_boosted[i] += 0.15  # Boost by 15%
-                        print(f"  Boosting {ref_name} (rectangular match)", file=sys.stderr)
-                        break
-                # Penalize round frames
-                for kw in round_keywords:
-                    if kw in ref_lower:
-                        sims_boosted[i] -= 0.1
-                        break
-            elif uploaded_shape.get("is_round"):
-                # Boost round frame references
-                for kw in round_keywords:
-                    if kw in ref_lower:
-                        sims_boosted[i] += 0.15
-                        print(f"  Boosting {ref_name} (round match)", file=sys.stderr)
-                        break
-                # Penalize rectangular frames
-                for kw in rectangular_keywords:
-                    if kw in ref_lower:
-                        sims_boosted[i] -= 0.1
-                        break
-        
-        best_idx = int(torch.argmax(sims_boosted).item())
-        best_score = float(sims[best_idx].item())  # Use original score for confidence
+        # Read the best index and its original (unboosted) score back in one transfer
+        best_idx_t = sims_boosted.argmax()
+        best_idx, best_score = torch.stack([best_idx_t.to(sims.dtype), sims[best_idx_t]]).tolist()
+        best_idx = int(best_idx) if candidates is None else int(candidates[int(best_idx)])
         best_ref = ref_filenames[best_idx]
 
         base = os.path.splitext(best_ref)[0]
@@ -812,11 +1007,20 @@ def clip_match(image_paths):
             **properties  # Include lensColor, frameColor, tintOpacity, frameMaterial, frameMetalness
         }
 
+    except (FileNotFoundError, ValueError) as e:
+        # Unreadable upload or a malformed cache: expected, no traceback needed
+        print(f"Matching error: {e}", file=sys.stderr)
+        return simple_match(image_paths)
+    except torch.cuda.OutOfMemoryError as e:
+        print(f"Matching error (GPU out of memory): {e}", file=sys.stderr)
+        torch.cuda.empty_cache()
+        return simple_match(image_paths)
     except Exception as e:
         print(f"Matching error: {e}", file=sys.stderr)
-        import traceback
+        if DEBUG:
+            import traceback
 
-        traceback.print_exc(file=sys.stderr)
+            traceback.print_exc(file=sys.stderr)
         return simple_match(image_paths)
 
 
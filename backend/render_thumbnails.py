@@ -5,10 +5,37 @@ Generate thumbnail images from GLB models using trimesh and pyrender
 
 import os
 import sys
+import functools
 import json
+import time
+import multiprocessing.util
 import boto3
+from io import BytesIO
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from boto3.s3.transfer import S3Transfer, TransferConfig
 from botocore.client import Config
 
+# Rendering dependencies are optional: without them thumbnails fall back to
+# the point-scatter render or to placeholders
+try:
+    from PIL import Image, ImageDraw, ImageFont
+    _HAVE_PIL = True
+except ImportError:
+    _HAVE_PIL = False
+
+try:
+    import numpy as np
+    import trimesh
+    _HAVE_TRIMESH = True
+except ImportError:
+    _HAVE_TRIMESH = False
+
+try:
+    import pyrender
+    _HAVE_PYRENDER = True
+except ImportError:
+    _HAVE_PYRENDER = False
+
 # Load environment variables
 from dotenv import load_dotenv
 load_dotenv()
@@ -21,29 +48,69 @@ S3_BUCKET = os.getenv('S3_BUCKET', 'jigu1')
 
 TEMP_DIR = 'temp_models'
 THUMB_DIR = 'reference_images'
+# Thumbnails are JPEG: far smaller than PNG and CLIP downsamples them to 224px anyway
+THUMB_EXT = '.jpg'
+
+# Models are rendered in parallel worker processes, RENDER_CHUNK at a time.
+# Inside a worker, downloads run PREFETCH models ahead and uploads finish in
+# the background while the next model renders; S3 calls are retried
+RENDER_WORKERS = min(8, os.cpu_count() or 1)
+RENDER_CHUNK = 4
+IO_WORKERS = 4
+PREFETCH = 2
+MAX_RETRIES = 3
+
+# Placeholder frame colors by filename keyword, highest priority first
+PLACEHOLDER_COLORS = {
+    'black': (26, 26, 26),
+    'gold': (255, 215, 0), 'yellow': (255, 215, 0),
+    'silver': (192, 192, 192), 'metal': (192, 192, 192),
+    'red': (220, 20, 60), 'bloody': (220, 20, 60),
+    'blue': (65, 105, 225),
+    'green': (34, 139, 34),
+    'pink': (255, 105, 180), 'rose': (255, 105, 180),
+    'white': (245, 245, 245),
+    'brown': (139, 69, 19),
+    'orange': (255, 140, 0),
+    'purple': (147, 112, 219),
+    'round': (100, 100, 100),
+    'cat': (80, 80, 80),
+    'aviator': (60, 60, 60),
+}
+DEFAULT_PLACEHOLDER_COLOR = (128, 128, 128)
 
 # Create directories
 os.makedirs(TEMP_DIR, exist_ok=True)
 os.makedirs(THUMB_DIR, exist_ok=True)
 
+_S3 = None
+
 def get_s3_client():
-    """Create S3 client for Wasabi"""
-    return boto3.client(
-        's3',
-        endpoint_url=f'https://{AWS_ENDPOINT}',
-        aws_access_key_id=AWS_ACCESS_KEY,
-        aws_secret_access_key=AWS_SECRET_KEY,
-        region_name=AWS_REGION,
-        config=Config(signature_version='s3v4')
-    )
+    """Return the shared S3 client for Wasabi (one connection pool for all transfers)"""
+    global _S3
+    if _S3 is None:
+        _S3 = boto3.client(
+            's3',
+            endpoint_url=f'https://{AWS_ENDPOINT}',
+            aws_access_key_id=AWS_ACCESS_KEY,
+            aws_secret_access_key=AWS_SECRET_KEY,
+            region_name=AWS_REGION,
+            # Enough connections for the background download/upload pool
+            config=Config(signature_version='s3v4', max_pool_connections=32)
+        )
+    return _S3
+
+def iter_objects(s3, prefix=''):
+    """Yield every object under prefix, following list_objects_v2 pagination"""
+    for page in s3.get_paginator('list_objects_v2').paginate(Bucket=S3_BUCKET, Prefix=prefix):
+        yield from page.get('Contents', [])
 
 def list_glb_models(s3):
     """List all GLB models in the bucket"""
     print("Fetching GLB models from S3...")
-    response = s3.list_objects_v2(Bucket=S3_BUCKET, MaxKeys=500)
     
     models = []
-    for obj in response.get('Contents', []):
+    for obj in iter_objects(s3):
         key = obj['Key']
         if key.lower().endswith('.glb'):
             # Skip person/human models
@@ -54,161 +121,195 @@ def list_glb_models(s3):
     return models
 
 def list_existing_thumbnails(s3):
-    """List existing thumbnails in S3"""
+    """Return the set of base names that already have a thumbnail in S3"""
     print("Checking existing thumbnails...")
     try:
-        response = s3.list_objects_v2(Bucket=S3_BUCKET, Prefix='reference_images/', MaxKeys=500)
-        thumbs = []
-        for obj in response.get('Contents', []):
+        thumbs = set()
+        for obj in iter_objects(s3, 'reference_images/'):
             key = obj['Key']
             if key.lower().endswith(('.jpg', '.jpeg', '.png')):
-                base = os.path.splitext(os.path.basename(key))[0]
-                thumbs.append(base)
+                thumbs.add(os.path.splitext(os.path.basename(key))[0])
         print(f"Found {len(thumbs)} existing thumbnails")
         return thumbs
     except:
-        return []
+        return set()
 
 def download_model(s3, key):
-    """Download a GLB model from S3"""
+    """Fetch a GLB model from S3 into memory, reusing the local copy if it is up to date"""
     local_path = os.path.join(TEMP_DIR, os.path.basename(key))
+    if os.path.exists(local_path):
+        head = s3.head_object(Bucket=S3_BUCKET, Key=key)
+        stat = os.stat(local_path)
+        if stat.st_size == head['ContentLength'] and stat.st_mtime >= head['LastModified'].timestamp():
+            print(f"  Using cached {key}")
+            with open(local_path, 'rb') as f:
+                return BytesIO(f.read())
+    
     print(f"  Downloading {key}...")
-    s3.download_file(S3_BUCKET, key, local_path)
-    return local_path
+    data = s3.get_object(Bucket=S3_BUCKET, Key=key)['Body'].read()
+    # Keep a copy so re-runs can skip the download; rendering reads from memory.
+    # Written under a temp name and renamed, so an interrupted run never leaves
+    # a truncated file that looks current
+    tmp_path = f"{local_path}.{os.getpid()}.part"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, local_path)
+    return BytesIO(data)
+
+_TRANSFER = None
+
+def get_transfer(s3):
+    """Return the shared S3Transfer (thread-safe, concurrent multipart uploads)"""
+    global _TRANSFER
+    if _TRANSFER is None:
+        _TRANSFER = S3Transfer(s3, TransferConfig(max_concurrency=16, use_threads=True))
+    return _TRANSFER
 
 def upload_thumbnail(s3, local_path, s3_key):
     """Upload thumbnail to S3"""
     print(f"  Uploading to {s3_key}...")
-    s3.upload_file(local_path, S3_BUCKET, s3_key, ExtraArgs={'ContentType': 'image/png'})
+    get_transfer(s3).upload_file(local_path, S3_BUCKET, s3_key, extra_args={'ContentType': 'image/jpeg'})
 
-def render_thumbnail_trimesh(glb_path, output_path):
-    """Render thumbnail using trimesh"""
-    try:
-        import trimesh
-        import numpy as np
-        from PIL import Image
+def save_thumbnail(img, output_path):
+    """Encode a thumbnail as JPEG"""
+    img.convert('RGB').save(output_path, 'JPEG', quality=85, optimize=True)
+
+def with_retries(fn, *args):
+    """Call fn(*args), retrying with exponential backoff (1s, 2s, ...) on failure"""
+    for attempt in range(MAX_RETRIES):
+        try:
+            return fn(*args)
+        except Exception as e:
+            if attempt == MAX_RETRIES - 1:
+                raise
+            print(f"  Retrying {fn.__name__} after error: {e}")
+            time.sleep(2 ** attempt)
+
+_RENDERER = None
+_PR_SCENE = None
+
+def get_pyrender_scene():
+    """Create the offscreen renderer and base scene once; the GL context is reused for every model"""
+    global _RENDERER, _PR_SCENE
+    if _RENDERER is None:
+        _RENDERER = pyrender.OffscreenRenderer(256, 256)
+        # Workers leave via os._exit, which skips atexit; multiprocessing runs
+        # its finalizers on worker (and main-process) exit
+        multiprocessing.util.Finalize(None, _RENDERER.delete, exitpriority=10)
         
+        _PR_SCENE = pyrender.Scene(bg_color=[240, 240, 240, 255])
+        # Directional light only depends on orientation; the camera poses
+        # used below never rotate, so one fixed light matches them all
+        light = pyrender.DirectionalLight(color=[1.0, 1.0, 1.0], intensity=3.0)
+        _PR_SCENE.add(light, pose=np.eye(4))
+    return _RENDERER, _PR_SCENE
+
+def render_thumbnail_trimesh(glb_file, output_path):
+    """Render thumbnail using trimesh from an in-memory GLB"""
+    try:
         # Load the GLB file
-        scene = trimesh.load(glb_path)
+        scene = trimesh.load(glb_file, file_type='glb')
         
-        # Get the scene or mesh
+        # Get the scene's meshes (kept separate, nothing is concatenated)
         if isinstance(scene, trimesh.Scene):
-            # Combine all meshes
-            meshes = []
-            for name, geom in scene.geometry.items():
-                if isinstance(geom, trimesh.Trimesh):
-                    meshes.append(geom)
-            if meshes:
-                mesh = trimesh.util.concatenate(meshes)
-            else:
+            meshes = [geom for geom in scene.geometry.values() if isinstance(geom, trimesh.Trimesh)]
+            if not meshes:
                 raise ValueError("No meshes found in scene")
         else:
-            mesh = scene
+            meshes = [scene]
         
-        # Try to render using pyrender if available
-        try:
-            import pyrender
-            
-            # Create scene
-            pr_scene = pyrender.Scene(bg_color=[240, 240, 240, 255])
+        # Overall bounding box across the submeshes
+        bounds = np.array([m.bounds for m in meshes])
+        lo = bounds[:, 0].min(axis=0)
+        hi = bounds[:, 1].max(axis=0)
+        
+        # Render using pyrender if available
+        if _HAVE_PYRENDER:
+            # Shared renderer and scene (light already in place)
+            renderer, pr_scene = get_pyrender_scene()
             
-            # Add mesh
-            pr_mesh = pyrender.Mesh.from_trimesh(mesh)
-            pr_scene.add(pr_mesh)
+            # Add each submesh as its own node
+            mesh_nodes = [pr_scene.add(pyrender.Mesh.from_trimesh(m)) for m in meshes]
             
             # Add camera
             camera = pyrender.PerspectiveCamera(yfov=np.pi / 3.0)
             
             # Position camera to see the whole model
-            bounds = mesh.bounds
-            center = mesh.centroid
-            size = np.max(bounds[1] - bounds[0])
+            center = (lo + hi) / 2
+            size = np.max(hi - lo)
             camera_distance = size * 2
             
             camera_pose = np.eye(4)
             camera_pose[:3, 3] = center + [0, 0, camera_distance]
-            pr_scene.add(camera, pose=camera_pose)
-            
-            # Add light
-            light = pyrender.DirectionalLight(color=[1.0, 1.0, 1.0], intensity=3.0)
-            pr_scene.add(light, pose=camera_pose)
+            cam_node = pr_scene.add(camera, pose=camera_pose)
             
-            # Render
-            renderer = pyrender.OffscreenRenderer(256, 256)
-            color, _ = renderer.render(pr_scene)
-            renderer.delete()
+            # Render, then take this model back out of the shared scene
+            try:
+                color, _ = renderer.render(pr_scene)
+            finally:
+                for node in mesh_nodes:
+                    pr_scene.remove_node(node)
+                pr_scene.remove_node(cam_node)
             
             # Save image
             img = Image.fromarray(color)
-            img.save(output_path)
+            save_thumbnail(img, output_path)
             return True
             
-        except ImportError:
+        else:
             # Fallback: create a simple visualization
             print("  pyrender not available, using simple render...")
             
-            # Create a simple top-down view
-            bounds = mesh.bounds
-            center = mesh.centroid
-            
-            # Project vertices to 2D
-            vertices = mesh.vertices - center
+            # Project vertices to 2D: only the positions are gathered
+            vertices = np.concatenate([m.vertices for m in meshes])
             
             # Simple orthographic projection (front view)
             x = vertices[:, 0]
             y = vertices[:, 1]
             
             # Normalize to image coordinates
-            x_min, x_max = x.min(), x.max()
-            y_min, y_max = y.min(), y.max()
+            x_min, y_min = lo[0], lo[1]
+            x_max, y_max = hi[0], hi[1]
             
             scale = min(200 / (x_max - x_min + 0.001), 200 / (y_max - y_min + 0.001))
             
             x_img = ((x - x_min) * scale + 28).astype(int)
             y_img = (256 - ((y - y_min) * scale + 28)).astype(int)
             
-            # Create image
-            img = Image.new('RGB', (256, 256), (240, 240, 240))
-            pixels = img.load()
+            # Draw points in one scatter (rows are y, columns are x)
+            arr = np.full((256, 256, 3), 240, dtype=np.uint8)
+            valid = (x_img >= 0) & (x_img < 256) & (y_img >= 0) & (y_img < 256)
+            arr[y_img[valid], x_img[valid]] = (50, 50, 50)
+            img = Image.fromarray(arr)
             
-            # Draw points
-            for xi, yi in zip(x_img, y_img):
-                if 0 <= xi < 256 and 0 <= yi < 256:
-                    pixels[xi, yi] = (50, 50, 50)
-            
-            img.save(output_path)
+            save_thumbnail(img, output_path)
             return True
             
     except Exception as e:
         print(f"  Render error: {e}")
         return False
 
-def create_placeholder_thumbnail(glb_path, output_path):
+@functools.lru_cache(maxsize=1)
+def _font():
+    """Label font for placeholders, loaded once"""
+    try:
+        return ImageFont.truetype("arial.ttf", 10)
+    except (OSError, ImportError):  # font missing, or Pillow built without FreeType
+        return ImageFont.load_default()
+
+def create_placeholder_thumbnail(model_key, output_path):
     """Create a simple placeholder thumbnail"""
+    if not _HAVE_PIL:
+        print("  Placeholder error: Pillow is not installed")
+        return False
     try:
-        from PIL import Image, ImageDraw, ImageFont
-        
-        base_name = os.path.splitext(os.path.basename(glb_path))[0]
+        base_name = os.path.splitext(os.path.basename(model_key))[0]
         
         # Determine color based on filename
-        color = (128, 128, 128)  # default gray
+        # First keyword in priority order that appears in the name
         name_lower = base_name.lower()
-        
-        if 'black' in name_lower: color = (26, 26, 26)
-        elif 'gold' in name_lower or 'yellow' in name_lower: color = (255, 215, 0)
-        elif 'silver' in name_lower or 'metal' in name_lower: color = (192, 192, 192)
-        elif 'red' in name_lower or 'bloody' in name_lower: color = (220, 20, 60)
-        elif 'blue' in name_lower: color = (65, 105, 225)
-        elif 'green' in name_lower: color = (34, 139, 34)
-        elif 'pink' in name_lower or 'rose' in name_lower: color = (255, 105, 180)
-        elif 'white' in name_lower: color = (245, 245, 245)
-        elif 'brown' in name_lower: color = (139, 69, 19)
-        elif 'orange' in name_lower: color = (255, 140, 0)
-        elif 'purple' in name_lower: color = (147, 112, 219)
-        elif 'round' in name_lower: color = (100, 100, 100)
-        elif 'cat' in name_lower: color = (80, 80, 80)
-        elif 'aviator' in name_lower: color = (60, 60, 60)
-        
+        color = next((c for kw, c in PLACEHOLDER_COLORS.items() if kw in name_lower), DEFAULT_PLACEHOLDER_COLOR)
+
         # Create image
         img = Image.new('RGB', (256, 256), (240, 240, 240))
         draw = ImageDraw.Draw(img)
@@ -226,21 +327,76 @@ def create_placeholder_thumbnail(glb_path, output_path):
         draw.line([216, 125, 246, 100], fill=color, width=2)
         
         # Add name
-        try:
-            font = ImageFont.truetype("arial.ttf", 10)
-        except:
-            font = ImageFont.load_default()
-        
         short_name = base_name[:25] + '...' if len(base_name) > 25 else base_name
-        draw.text((128, 200), short_name, fill=(100, 100, 100), anchor="mm", font=font)
+        draw.text((128, 200), short_name, fill=(100, 100, 100), anchor="mm", font=_font())
         
-        img.save(output_path)
+        save_thumbnail(img, output_path)
         return True
         
     except Exception as e:
         print(f"  Placeholder error: {e}")
         return False
 
+def _init_worker():
+    """Drop per-process state inherited on fork; each worker opens its own S3 client and GL context"""
+    global _S3, _TRANSFER, _RENDERER, _PR_SCENE
+    _S3 = _TRANSFER = _RENDERER = _PR_SCENE = None
+
+def render_model(model_key, glb_file):
+    """Render (or fall back to a placeholder for) one model; returns the thumbnail path, or None"""
+    base_name = os.path.splitext(os.path.basename(model_key))[0]
+    thumb_path = os.path.join(THUMB_DIR, f"{base_name}{THUMB_EXT}")
+    
+    success = False
+    if _HAVE_TRIMESH and _HAVE_PIL:
+        success = render_thumbnail_trimesh(glb_file, thumb_path)
+    
+    if not success:
+        success = create_placeholder_thumbnail(model_key, thumb_path)
+    
+    return thumb_path if success and os.path.exists(thumb_path) else None
+
+def process_models(model_keys):
+    """Download, render and upload a run of models in one worker; returns a success flag per model"""
+    s3 = get_s3_client()
+    results = [False] * len(model_keys)
+    
+    with ThreadPoolExecutor(max_workers=IO_WORKERS) as io_pool:
+        downloads = {k: io_pool.submit(with_retries, download_model, s3, k) for k in model_keys[:PREFETCH]}
+        pending_uploads = {}
+        
+        for i, model_key in enumerate(model_keys):
+            base_name = os.path.splitext(os.path.basename(model_key))[0]
+            print(f"\n{base_name}")
+            
+            if i + PREFETCH < len(model_keys):
+                next_key = model_keys[i + PREFETCH]
+                downloads[next_key] = io_pool.submit(with_retries, download_model, s3, next_key)
+            
+            try:
+                # Wait for the (prefetched) download
+                glb_file = downloads.pop(model_key).result()
+                thumb_path = render_model(model_key, glb_file)
+                if thumb_path:
+                    # Upload in the background while the next model renders
+                    pending_uploads[i] = io_pool.submit(
+                        with_retries, upload_thumbnail, s3, thumb_path, f"reference_images/{base_name}{THUMB_EXT}"
+                    )
+                else:
+                    print(f"  ❌ Failed to create thumbnail for {base_name}")
+            except Exception as e:
+                print(f"  ❌ Error for {base_name}: {e}")
+        
+        # Wait for the remaining uploads
+        for i, upload in pending_uploads.items():
+            try:
+                upload.result()
+                results[i] = True
+            except Exception as e:
+                print(f"  ❌ Upload failed for {model_keys[i]}: {e}")
+    
+    return results
+
 def main():
     print("=== GLB Thumbnail Generator ===\n")
     
@@ -259,51 +415,37 @@ def main():
         return
     
     # Check if trimesh is available
-    try:
-        import trimesh
-        use_trimesh = True
+    use_trimesh = _HAVE_TRIMESH and _HAVE_PIL
+    if use_trimesh:
         print("Using trimesh for rendering")
-    except ImportError:
-        use_trimesh = False
+    else:
         print("trimesh not available, using placeholder images")
         print("Install with: pip install trimesh pillow")
     
     processed = 0
     failed = 0
     
-    for i, model_key in enumerate(to_process):
-        base_name = os.path.splitext(os.path.basename(model_key))[0]
-        print(f"\n[{i+1}/{len(to_process)}] {base_name}")
-        
-        try:
-            # Download model
-            local_glb = download_model(s3, model_key)
-            thumb_path = os.path.join(THUMB_DIR, f"{base_name}.png")
-            
-            # Render thumbnail
-            success = False
-            if use_trimesh:
-                success = render_thumbnail_trimesh(local_glb, thumb_path)
-            
-            if not success:
-                success = create_placeholder_thumbnail(local_glb, thumb_path)
-            
-            if success and os.path.exists(thumb_path):
-                # Upload to S3
-                upload_thumbnail(s3, thumb_path, f"reference_images/{base_name}.png")
-                print("  ✅ Success")
-                processed += 1
-            else:
-                print("  ❌ Failed to create thumbnail")
-                failed += 1
-            
-            # Cleanup
-            if os.path.exists(local_glb):
-                os.remove(local_glb)
-                
-        except Exception as e:
-            print(f"  ❌ Error: {e}")
-            failed += 1
+    # Each worker takes RENDER_CHUNK consecutive models and overlaps their I/O with rendering
+    chunks = [to_process[i:i + RENDER_CHUNK] for i in range(0, len(to_process), RENDER_CHUNK)]
+    with ProcessPoolExecutor(max_workers=RENDER_WORKERS, initializer=_init_worker) as pool:
+        futures = [(chunk, pool.submit(process_models, chunk)) for chunk in chunks]
+        done = 0
+        for chunk, future in futures:
+            try:
+                results = future.result()
+            except Exception as e:
+                # A worker died (e.g. a crash in the GL driver). That breaks the pool, so this
+                # and every unfinished chunk is counted as failed; finished ones still count
+                print(f"  ❌ Worker failed on {len(chunk)} models: {e!r}")
+                results = [False] * len(chunk)
+            for model_key, ok in zip(chunk, results):
+                done += 1
+                base_name = os.path.splitext(os.path.basename(model_key))[0]
+                print(f"[{done}/{len(to_process)}] {base_name}: {'✅ done' if ok else '❌ failed'}")
+                if ok:
+                    processed += 1
+                else:
+                    failed += 1
     
     print(f"\n=== Summary ===")
     print(f"Processed: {processed + failed}")
@@ -312,7 +454,9 @@ def main():
     
     if processed > 0:
         print("\nBuilding AI embeddings...")
-        os.system("python match.py --build")
+        # In-process, so no second interpreter start-up just for the build
+        from match import build_embeddings
+        build_embeddings()
 
 if __name__ == "__main__":
     main()